@@ -1,18 +1,32 @@
 import google.generativeai as genai
+from google.generativeai import caching
 import os
+import asyncio
+import hashlib
 import telebot
-from collections import defaultdict
+import telebot.asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import aiohttp
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from boto3 import client as boto3_client
-from pydub import AudioSegment
+from botocore.config import Config
+import aioboto3
+from fastapi import FastAPI, Request
+import uvicorn
 import keyring
-import gc
-from contextlib import contextmanager
+from contextlib import AsyncExitStack
 import logging
+import re
 import requests
-import tempfile
-import base64
-import aiohttp
+import sqlite3
+import unicodedata
+import threading
+from io import BytesIO
+import sqlite_vec
+import pysbd
+from aiolimiter import AsyncLimiter
+from sentence_transformers import SentenceTransformer
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -34,15 +48,26 @@ logger = logging.getLogger(__name__)
 #         return False
 
 def get_deployment_mode():
-    """Get deployment mode from AWS Parameter Store or default to local"""
+    """Get deployment mode by probing the EC2 instance metadata service"""
     try:
-        # First check if we're actually in AWS by trying to access instance metadata
-        requests.get('http://169.254.169.254/latest/meta-data/', timeout=1)
+        # IMDSv2: fetch a session token first. The service is link-local, so
+        # a short timeout is plenty and keeps local cold starts fast
+        token = requests.put(
+            'http://169.254.169.254/latest/api/token',
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'},
+            timeout=0.2
+        )
+        token.raise_for_status()
+        requests.get(
+            'http://169.254.169.254/latest/meta-data/',
+            headers={'X-aws-ec2-metadata-token': token.text},
+            timeout=0.2
+        ).raise_for_status()
         logger.info("Running on AWS instance")
-        
+
         # If we are in AWS, use instance role credentials
         return 'aws'
-        
+
     except (requests.RequestException, Exception) as e:
         logger.info("Not running on AWS instance, defaulting to local mode")
         return 'local'
@@ -60,15 +85,14 @@ def get_aws_parameter(parameter_name):
         return None
 
 # Get credentials based on deployment mode
-deployment_mode = get_deployment_mode()
-if deployment_mode == 'aws':
+if DEPLOYMENT_MODE == 'aws':
     logger.info("Running in AWS mode - using instance role credentials")
     # Use instance role credentials for AWS services
     telegram_token = get_aws_parameter('galebach_spanish_bot_token')
     genai.configure(api_key=get_aws_parameter('GOOGLE_AI_API_KEY'))
-    
-    # Create AWS clients using instance role credentials
-    polly = boto3_client('polly', region_name='us-east-1')
+
+    # Polly client uses instance role credentials
+    polly_client_kwargs = {'region_name': 'us-east-1'}
 
 else:
     logger.info("Running in local mode - getting credentials from keyring")
@@ -81,11 +105,26 @@ else:
     aws_region = keyring.get_password('api_default_AWS_DEFAULT_REGION', 'AWS_DEFAULT_REGION')
 
     # Configure Polly with explicit credentials for local mode
-    polly = boto3_client('polly',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
-    )
+    polly_client_kwargs = {
+        'aws_access_key_id': aws_access_key,
+        'aws_secret_access_key': aws_secret_key,
+        'region_name': aws_region
+    }
+
+# Boto defaults allow a cold connection to stall the first Polly call for up
+# to a minute; fail fast, retry once, and keep pooled connections alive instead
+POLLY_CONFIG = Config(
+    connect_timeout=5,
+    read_timeout=10,
+    retries={'max_attempts': 2, 'mode': 'standard'},
+    max_pool_connections=20,
+    tcp_keepalive=True
+)
+
+# Async Polly client - entered once at server startup so the connection pool is reused
+polly_session = aioboto3.Session()
+polly = None
+_polly_stack = AsyncExitStack()
 
 # Verify all credentials were retrieved
 required_credentials = {
@@ -98,20 +137,81 @@ for cred_name, cred_value in required_credentials.items():
         raise ValueError(f"Missing required credential: {cred_name}")
 
 # Configure services with credentials
-bot = telebot.TeleBot(telegram_token)
+bot = AsyncTeleBot(telegram_token)
+
+# telebot's asyncio helper lazily opens a default ClientSession for all bot
+# API calls; swap in one backed by a pooled keepalive connector so reply_to /
+# send_voice / get_file reuse warm TLS connections instead of paying a
+# handshake (~100ms) per call
+async def _pooled_telegram_session():
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=75)
+    )
+    telebot.asyncio_helper.session_manager.session = session
+    return session
+
+telebot.asyncio_helper.session_manager.create_session = _pooled_telegram_session
 
-@contextmanager
-def model_context():
-    """Context manager for Gemini model cleanup"""
+# Webhook configuration - the secret path keeps third parties from posting fake updates
+PUBLIC_URL = os.environ.get('PUBLIC_URL', '')
+WEBHOOK_PATH = '/webhook/' + hashlib.sha256(telegram_token.encode()).hexdigest()[:32]
+
+GEMINI_MODEL_NAME = 'models/gemini-2.0-flash-exp'
+
+# Explicit Gemini context cache for the fixed system prompt - created lazily,
+# recreated when its TTL lapses. Cached tokens are billed at a steep discount
+# and skip prefill on every turn.
+_prompt_cache = None
+_prompt_cache_unavailable = False
+
+def get_prompt_cache():
+    """Return the CachedContent holding GEMINI_PROMPT, or None if caching is unavailable"""
+    global _prompt_cache, _prompt_cache_unavailable
+    if _prompt_cache_unavailable:
+        return None
+    if _prompt_cache is not None:
+        if datetime.now(_prompt_cache.expire_time.tzinfo) < _prompt_cache.expire_time:
+            return _prompt_cache
+        _prompt_cache = None
     try:
-        model = genai.GenerativeModel('models/gemini-2.0-flash-exp')
-        yield model
-    finally:
-        del model
-        gc.collect()
+        _prompt_cache = caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME,
+            system_instruction=GEMINI_PROMPT,
+            ttl=timedelta(minutes=30)
+        )
+        logger.info(f"Created Gemini prompt cache: {_prompt_cache.name}")
+    except Exception as e:
+        # Most likely the prompt is below Gemini's minimum cacheable token
+        # count - fall back to inlining it and don't retry every call
+        logger.info(f"Gemini context cache unavailable, inlining prompt: {e}")
+        _prompt_cache_unavailable = True
+    return _prompt_cache
 
-# Initialize Gemini model
-model = genai.GenerativeModel('models/gemini-2.0-flash-exp')
+# Initialize Gemini model - GenerativeModel is a thin stateless wrapper, so
+# one instance serves every request (used when the context cache is unavailable)
+model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+# Model bound to the current prompt-cache generation
+_cached_model = None
+_cached_model_cache_name = None
+
+# get_model runs on worker threads (asyncio.to_thread) because creating or
+# refreshing the CachedContent is a synchronous HTTP call that would stall
+# every user if it ran on the event loop; the lock keeps concurrent refreshes
+# from racing
+_model_lock = threading.Lock()
+
+def get_model():
+    """Return (model, prompt_cached) - a cached-content model when available"""
+    global _cached_model, _cached_model_cache_name
+    with _model_lock:
+        cache = get_prompt_cache()
+        if cache is None:
+            return model, False
+        if _cached_model is None or _cached_model_cache_name != cache.name:
+            _cached_model = genai.GenerativeModel.from_cached_content(cache)
+            _cached_model_cache_name = cache.name
+        return _cached_model, True
 
 GEMINI_PROMPT = """Your role is to help them practice and learn Spanish. 
 Listen to their audio messages and respond naturally to what they say. ALWAYS respond in SPANISH!!!
@@ -129,213 +229,437 @@ Instead of just answering directly, expand on the topic and provide rich context
 
 # Add conversation history storage
 class ConversationManager:
-    def __init__(self, expiry_minutes=30):
-        self.conversations = defaultdict(list)
+    def __init__(self, expiry_minutes=30, max_turns=8):
+        self.conversations = defaultdict(deque)
+        # Pre-rendered "User: .../Assistant: ..." prompt text per user,
+        # appended in O(1) per turn instead of rebuilt from the whole
+        # history on every Gemini call
+        self.prompt_prefix = defaultdict(str)
         self.expiry_minutes = expiry_minutes
-        
+        # Keep at most this many user/assistant exchange pairs; older turns
+        # stop paying prefill cost on every call. Combined with the cached
+        # system prompt this keeps per-turn prompt size near-constant
+        self.max_messages = 2 * max_turns
+
+    @staticmethod
+    def _format_line(role, content):
+        label = "User" if role == 'user' else "Assistant"
+        return f"{label}: {content}\n"
+
     def add_message(self, user_id, role, content):
-        # Clean expired conversations first
-        self._clean_expired()
-        
-        self.conversations[user_id].append({
+        # Clean this user's expired messages first
+        self._clean_expired_for(user_id)
+
+        line = self._format_line(role, content)
+        messages = self.conversations[user_id]
+        messages.append({
             'role': role,
             'content': content,
-            'timestamp': datetime.now()
+            'timestamp': datetime.now(),
+            'line': line
         })
-    
+        self.prompt_prefix[user_id] += line
+
+        # Trim to the rolling window
+        if len(messages) > self.max_messages:
+            while len(messages) > self.max_messages:
+                messages.popleft()
+            self.prompt_prefix[user_id] = ''.join(msg['line'] for msg in messages)
+
     def get_history(self, user_id):
+        self._clean_expired_for(user_id)
         return [
             {'role': msg['role'], 'content': msg['content']}
             for msg in self.conversations[user_id]
         ]
-    
-    def _clean_expired(self):
-        current_time = datetime.now()
-        for user_id in list(self.conversations.keys()):
-            self.conversations[user_id] = [
-                msg for msg in self.conversations[user_id]
-                if current_time - msg['timestamp'] < timedelta(minutes=self.expiry_minutes)
-            ]
-    
+
+    def get_prompt_prefix(self, user_id):
+        """Return the user's history already rendered as prompt text"""
+        self._clean_expired_for(user_id)
+        return self.prompt_prefix[user_id]
+
+    def _clean_expired_for(self, user_id):
+        """
+        Drop this user's expired messages from the left of the deque.
+        Timestamps are append-ordered, so this is O(expired) rather than a
+        sweep over every user's full history
+        """
+        messages = self.conversations[user_id]
+        cutoff = datetime.now() - timedelta(minutes=self.expiry_minutes)
+        expired = False
+        while messages and messages[0]['timestamp'] < cutoff:
+            messages.popleft()
+            expired = True
+        if expired:
+            self.prompt_prefix[user_id] = ''.join(msg['line'] for msg in messages)
+
     def clear_history(self, user_id):
         """
         Clear conversation history for a specific user
         """
         if user_id in self.conversations:
             del self.conversations[user_id]
+        self.prompt_prefix.pop(user_id, None)
+
+# Semantic cache for repeated tutor prompts
+class SemanticCache:
+    """
+    Embedding-based cache of (user utterance -> tutor reply + synthesized audio)
+
+    Language practice is highly repetitive ("¿Cómo se dice...?", greetings,
+    common drills). When a new message is a near-duplicate of one we already
+    answered, reuse both the Gemini reply and the Polly audio instead of
+    paying for either. Keys include the previous assistant turn so the same
+    words in a different context don't collide.
+    """
+    def __init__(self, db_path='semantic_cache.db', similarity_threshold=0.9, expiry_hours=24):
+        self.similarity_threshold = similarity_threshold
+        self.expiry_hours = expiry_hours
+        self.encoder = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        # Calls run on worker threads (asyncio.to_thread); serialize access
+        # to the shared sqlite connection
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.enable_load_extension(True)
+        sqlite_vec.load(self.db)
+        self.db.enable_load_extension(False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                response TEXT,
+                created_at TEXT
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS cache_audio (
+                entry_id INTEGER,
+                seq INTEGER,
+                clip BLOB
+            )
+        """)
+        self.db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS cache_vectors
+            USING vec0(
+                user_id integer partition key,
+                embedding float[384] distance_metric=cosine
+            )
+        """)
+        self.db.commit()
+
+    def _embed(self, text):
+        return self.encoder.encode(text, normalize_embeddings=True).astype('float32').tobytes()
+
+    def lookup(self, user_id, key_text):
+        """Return (response, audio_bytes) for a near-duplicate utterance, or None"""
+        try:
+            embedding = self._embed(key_text)
+            # user_id is a vec0 partition key, so the KNN search only scans
+            # this user's vectors - another user's entries can't crowd their
+            # matches out of the candidate set
+            with self.db_lock:
+                rows = self.db.execute("""
+                    SELECT e.id, e.response, e.created_at, v.distance
+                    FROM cache_vectors v
+                    JOIN cache_entries e ON e.id = v.rowid
+                    WHERE v.embedding MATCH ? AND v.k = 5 AND v.user_id = ?
+                    ORDER BY v.distance
+                """, (embedding, user_id)).fetchall()
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {e}")
+            return None
+
+        cutoff = datetime.now() - timedelta(hours=self.expiry_hours)
+        for entry_id, response, created_at, distance in rows:
+            if datetime.fromisoformat(created_at) < cutoff:
+                self._evict(entry_id)
+                continue
+            # vec0 cosine distance = 1 - cosine similarity
+            similarity = 1.0 - distance
+            if similarity >= self.similarity_threshold:
+                logger.info(f"Semantic cache hit (similarity={similarity:.3f})")
+                with self.db_lock:
+                    clips = [row[0] for row in self.db.execute(
+                        "SELECT clip FROM cache_audio WHERE entry_id = ? ORDER BY seq",
+                        (entry_id,)
+                    ).fetchall()]
+                return response, clips
+        return None
+
+    def store(self, user_id, key_text, response, audio_clips):
+        """Cache the reply and its per-sentence audio clips for this utterance"""
+        try:
+            # Expired entries only get evicted lazily when a lookup surfaces
+            # them; sweep here too so rows (and their audio blobs) that never
+            # resurface don't accumulate forever
+            self._purge_expired()
+            embedding = self._embed(key_text)
+            with self.db_lock:
+                cursor = self.db.execute(
+                    "INSERT INTO cache_entries (user_id, response, created_at) VALUES (?, ?, ?)",
+                    (user_id, response, datetime.now().isoformat())
+                )
+                for seq, clip in enumerate(audio_clips):
+                    self.db.execute(
+                        "INSERT INTO cache_audio (entry_id, seq, clip) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, seq, clip)
+                    )
+                self.db.execute(
+                    "INSERT INTO cache_vectors (rowid, user_id, embedding) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, user_id, embedding)
+                )
+                self.db.commit()
+        except Exception as e:
+            logger.error(f"Semantic cache store failed: {e}")
+
+    def clear_user(self, user_id):
+        """Drop all cached entries for a user (used by 'clear history')"""
+        with self.db_lock:
+            entry_ids = [row[0] for row in self.db.execute(
+                "SELECT id FROM cache_entries WHERE user_id = ?", (user_id,)
+            ).fetchall()]
+        for entry_id in entry_ids:
+            self._evict(entry_id)
+
+    def _purge_expired(self):
+        """Delete every entry past the TTL, regardless of user"""
+        cutoff = (datetime.now() - timedelta(hours=self.expiry_hours)).isoformat()
+        with self.db_lock:
+            expired = [row[0] for row in self.db.execute(
+                "SELECT id FROM cache_entries WHERE created_at < ?", (cutoff,)
+            ).fetchall()]
+        for entry_id in expired:
+            self._evict(entry_id)
+
+    def _evict(self, entry_id):
+        with self.db_lock:
+            self.db.execute("DELETE FROM cache_entries WHERE id = ?", (entry_id,))
+            self.db.execute("DELETE FROM cache_audio WHERE entry_id = ?", (entry_id,))
+            self.db.execute("DELETE FROM cache_vectors WHERE rowid = ?", (entry_id,))
+            self.db.commit()
 
 # Initialize conversation manager after bot initialization
 conversation_manager = ConversationManager()
+semantic_cache = SemanticCache()
 
 # Extract common response generation logic into a helper function
-def generate_gemini_response(prompt, user_id, input_content, file=None):
+async def generate_gemini_response(prompt, user_id, input_content, file=None):
     """Generate response from Gemini model with conversation history"""
-    try:
-        with model_context() as current_model:
-            # Get conversation history
-            history = conversation_manager.get_history(user_id)
-            
-            # Create the prompt with history context
-            full_prompt = prompt + "\n\nConversation history:\n"
-            for msg in history:
-                role = "User" if msg['role'] == 'user' else "Assistant"
-                full_prompt += f"{role}: {msg['content']}\n"
-            
-            # Generate response
-            if file:
-                response = current_model.generate_content([full_prompt, file])
-            else:
-                response = current_model.generate_content(full_prompt + f"\nUser: {input_content}")
-            
-            # Store interaction history
-            conversation_manager.add_message(user_id, 'user', input_content)
-            conversation_manager.add_message(user_id, 'assistant', response.text)
-            
-            return response.text
-    finally:
-        gc.collect()
+    current_model, prompt_cached = await asyncio.to_thread(get_model)
+
+    # Use the pre-rendered history prefix; when the system prompt is
+    # served from the context cache, only send the history
+    history_prefix = conversation_manager.get_prompt_prefix(user_id)
+    if prompt_cached:
+        full_prompt = "Conversation history:\n" + history_prefix
+    else:
+        full_prompt = prompt + "\n\nConversation history:\n" + history_prefix
+
+    # Generate response
+    if file:
+        response = await current_model.generate_content_async([full_prompt, file])
+    else:
+        response = await current_model.generate_content_async(full_prompt + f"\nUser: {input_content}")
+
+    # Store interaction history
+    conversation_manager.add_message(user_id, 'user', input_content)
+    conversation_manager.add_message(user_id, 'assistant', response.text)
 
-def synthesize_speech(text):
+    return response.text
+
+async def synthesize_speech(text):
     """
     Generate speech from text using Amazon Polly
-    Returns: Path to temporary WAV file
+    Returns: BytesIO holding the OGG audio
     """
     try:
-        # Use neural engine with Spanish voice
-        response = polly.synthesize_speech(
+        # Use neural engine with Spanish voice; OGG is what Telegram voice
+        # notes use natively, so the stream passes straight through with no
+        # reformat step and ~5x fewer bytes than 16-bit PCM
+        response = await polly.synthesize_speech(
             Text=text,
-            OutputFormat='pcm',
+            OutputFormat='ogg_vorbis',
             VoiceId='Lupe',  # Mexican Spanish female voice
             Engine='neural',
             LanguageCode='es-MX',
             SampleRate='16000'
         )
-        
-        # Create temporary WAV file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            # Add debug logging
-            print(f"Creating temporary file: {temp_file.name}")
-            
-            # Read audio stream data
-            audio_data = response['AudioStream'].read()
-            print(f"Received audio data length: {len(audio_data)} bytes")
-            
-            try:
-                # Convert PCM to WAV
-                audio = AudioSegment(
-                    data=audio_data,
-                    sample_width=2,
-                    frame_rate=16000,
-                    channels=1
-                )
-                audio.export(temp_file.name, format="wav")
-                print(f"Successfully exported WAV file to: {temp_file.name}")
-                return temp_file.name
-            except Exception as e:
-                print(f"Error in audio conversion: {str(e)}")
-                raise
-                
+
+        # Read the audio stream in 4 KB chunks as Polly produces it instead
+        # of blocking on the whole body in one read; for long sentences the
+        # copy overlaps synthesis instead of following it
+        buffer = BytesIO()
+        async with response['AudioStream'] as stream:
+            while True:
+                chunk = await stream.read(4096)
+                if not chunk:
+                    break
+                buffer.write(chunk)
+        logger.debug(f"Received audio data length: {buffer.tell()} bytes")
+
+        buffer.seek(0)
+        return buffer
+
     except Exception as e:
-        print(f"Error in speech synthesis: {str(e)}")
+        logger.error(f"Error in speech synthesis: {str(e)}")
         raise
 
-def download_file(file_info):
-    """Download a file from Telegram servers synchronously"""
+def canon(text):
+    """
+    Canonicalize user text: NFC-compose accents (iOS keyboards often send
+    NFD), collapse runs of whitespace, and trim. Raises exact- and
+    semantic-cache hit rates and makes command checks reliable
+    """
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+# Telegram allows ~30 messages/sec globally and ~1/sec per chat. Pacing
+# outbound sends locally is cheaper than blowing through the limit and eating
+# a 429 plus its retry-after backoff under bursts (long replies split into
+# several voice notes, multiple users at once)
+global_send_limiter = AsyncLimiter(30, 1)
+chat_send_limiters = defaultdict(lambda: AsyncLimiter(1, 1))
+
+async def rate_limited_reply(message, text):
+    async with global_send_limiter, chat_send_limiters[message.chat.id]:
+        return await bot.reply_to(message, text)
+
+async def rate_limited_send_voice(chat_id, audio):
+    async with global_send_limiter, chat_send_limiters[chat_id]:
+        return await bot.send_voice(chat_id, audio)
+
+# Sentence segmenter for pipelined speech synthesis
+sentence_segmenter = pysbd.Segmenter(language='es', clean=True)
+
+# Cap concurrent Polly requests; 3 is enough to saturate the pipeline while
+# staying under Telegram's ~1 msg/chat/sec send rate
+POLLY_CONCURRENCY = 3
+polly_semaphore = asyncio.Semaphore(POLLY_CONCURRENCY)
+
+async def _synthesize_bounded(sentence):
+    async with polly_semaphore:
+        return await synthesize_speech(sentence)
+
+async def send_voice_response(chat_id, response_text):
+    """
+    Send the reply as per-sentence voice notes. All sentences are submitted
+    to Polly up front (bounded by POLLY_CONCURRENCY) and delivered strictly
+    in sentence order as each clip completes
+    Returns: list of audio clips (bytes), in sentence order
+    """
+    sentences = [s.strip() for s in sentence_segmenter.segment(response_text) if s.strip()]
+    if not sentences:
+        return []
+
+    tasks = [asyncio.create_task(_synthesize_bounded(s)) for s in sentences]
+    clips = []
     try:
-        # Get the full file path from Telegram's API
-        file_path = f"https://api.telegram.org/file/bot{telegram_token}/{file_info.file_path}"
-        
-        response = requests.get(file_path)
-        response.raise_for_status()  # Raise exception for bad status codes
-        return response.content
-    except Exception as e:
-        logger.error(f"Error downloading file: {str(e)}")
-        raise
+        for task in tasks:
+            clip = (await task).getvalue()
+            await rate_limited_send_voice(chat_id, clip)
+            clips.append(clip)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return clips
 
 @bot.message_handler(content_types=['text'])
-def handle_text(message):
+async def handle_text(message):
     try:
+        text = canon(message.text)
+
         # Check if user wants to clear history
-        if message.text.lower() == "clear history":
+        if text.lower() == "clear history":
             conversation_manager.clear_history(message.from_user.id)
-            bot.reply_to(message, "¡Historial de conversación borrado! Empecemos de nuevo.")
+            await asyncio.to_thread(semantic_cache.clear_user, message.from_user.id)
+            await rate_limited_reply(message, "¡Historial de conversación borrado! Empecemos de nuevo.")
             return
-            
+
+        user_id = message.from_user.id
+
+        # Key the cache on the previous assistant turn plus the new message so
+        # the same words in a different context don't collide
+        history = conversation_manager.get_history(user_id)
+        history_tail = history[-1]['content'] if history else ''
+        cache_key = f"{history_tail}\n{text}" if history_tail else text
+
+        # Embedding inference and sqlite I/O are blocking; run them on a
+        # worker thread so other users' updates keep flowing
+        cached = await asyncio.to_thread(semantic_cache.lookup, user_id, cache_key)
+        if cached:
+            response, audio_clips = cached
+            conversation_manager.add_message(user_id, 'user', text)
+            conversation_manager.add_message(user_id, 'assistant', response)
+            await rate_limited_reply(message, response)
+            for clip in audio_clips:
+                await rate_limited_send_voice(message.chat.id, clip)
+            return
+
         # Get text response from Gemini
-        response = generate_gemini_response(
-            GEMINI_PROMPT, 
-            message.from_user.id,
-            message.text
+        response = await generate_gemini_response(
+            GEMINI_PROMPT,
+            user_id,
+            text
         )
-        
-        # Generate audio response
-        audio_file = synthesize_speech(response)
-        
-        # Send text and audio responses
-        bot.reply_to(message, response)
-        with open(audio_file, 'rb') as audio:
-            bot.send_voice(message.chat.id, audio)
-            
-        # Cleanup temporary file
-        os.unlink(audio_file)
-            
+
+        # Send the text reply, then pipeline per-sentence voice notes
+        await rate_limited_reply(message, response)
+        audio_clips = await send_voice_response(message.chat.id, response)
+        await asyncio.to_thread(semantic_cache.store, user_id, cache_key, response, audio_clips)
+
     except Exception as e:
-        bot.reply_to(message, f"Sorry, there was an error processing your message: {str(e)}")
+        await rate_limited_reply(message, f"Sorry, there was an error processing your message: {str(e)}")
 
 @bot.message_handler(content_types=['voice', 'audio'])
-def handle_audio(message):
+async def handle_audio(message):
     """
     Handle voice messages and audio files from Telegram
     Supports both voice messages and audio file uploads
     """
     try:
         # Send processing message
-        processing_msg = bot.reply_to(message, "Processing your audio... Please wait.")
-        
+        processing_msg = await rate_limited_reply(message, "Processing your audio... Please wait.")
+
         # Get file info and determine correct mime type
         if message.voice:
-            file_info = bot.get_file(message.voice.file_id)
+            file_info = await bot.get_file(message.voice.file_id)
             # Telegram voice messages are always in OGG format with OPUS codec
             mime_type = 'audio/ogg; codecs=opus'
         else:
-            file_info = bot.get_file(message.audio.file_id)
+            file_info = await bot.get_file(message.audio.file_id)
             # For audio files, use the mime type provided by Telegram
             mime_type = getattr(message.audio, 'mime_type', 'audio/ogg')
 
         # Download audio data using file_path from file_info
         if not hasattr(file_info, 'file_path'):
             raise ValueError("Could not get file path from Telegram")
-            
-        audio_data = download_file(file_info)
+
+        audio_data = await bot.download_file(file_info.file_path)
         logger.info(f"Downloaded audio file, size: {len(audio_data)} bytes, mime_type: {mime_type}")
         
-        # Create properly formatted Gemini content
+        # Create properly formatted Gemini content - the SDK takes the raw
+        # bytes inline, no base64 round-trip or disk copy needed
         gemini_file = {
             "inline_data": {
                 "mime_type": mime_type,
-                "data": base64.b64encode(audio_data).decode('utf-8')
+                "data": audio_data
             }
         }
 
         # Generate response using the helper function
-        response = generate_gemini_response(
+        response = await generate_gemini_response(
             GEMINI_PROMPT,
             message.from_user.id,
             'Audio message sent',
             gemini_file
         )
-        
+
         # Delete processing message
-        bot.delete_message(message.chat.id, processing_msg.message_id)
-        
-        # Generate audio response
-        audio_file = synthesize_speech(response)
-        
-        # Send text and audio responses
-        bot.reply_to(message, response)
-        with open(audio_file, 'rb') as audio:
-            bot.send_voice(message.chat.id, audio)
-            
+        await bot.delete_message(message.chat.id, processing_msg.message_id)
+
+        # Send the text reply, then pipeline per-sentence voice notes
+        await rate_limited_reply(message, response)
+        await send_voice_response(message.chat.id, response)
+
     except Exception as e:
         logger.error(f"Error processing audio: {str(e)}", exc_info=True)
         error_message = (
@@ -343,13 +667,69 @@ def handle_audio(message):
             f"Error: {str(e)}\n\n"
             "Note: telegram bots have a 20MB file limit."
         )
-        bot.reply_to(message, error_message)
-    finally:
-        # Cleanup temporary file if it exists
-        if 'audio_file' in locals() and os.path.exists(audio_file):
-            os.unlink(audio_file)
+        await rate_limited_reply(message, error_message)
+
+# Webhook server - Telegram pushes updates here instead of the bot polling for them
+app = FastAPI()
+
+async def _polly_keepalive(interval_seconds=240):
+    """
+    Ping Polly every few minutes so the pooled connections stay warm.
+    The first call against a cold pool after idle can stall for seconds
+    even with tuned timeouts; a cheap describe_voices prevents that
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await polly.describe_voices(LanguageCode='es-MX')
+        except Exception as e:
+            logger.info(f"Polly keepalive ping failed: {e}")
+
+_polly_keepalive_task = None
+
+@app.on_event("startup")
+async def register_webhook():
+    if not PUBLIC_URL:
+        raise ValueError("Missing required credential: PUBLIC_URL")
+    global polly, _polly_keepalive_task
+    polly = await _polly_stack.enter_async_context(
+        polly_session.client('polly', config=POLLY_CONFIG, **polly_client_kwargs)
+    )
+    _polly_keepalive_task = asyncio.create_task(_polly_keepalive())
+    # Pre-create the Gemini prompt cache so the first user doesn't pay for it
+    await asyncio.to_thread(get_model)
+    await bot.remove_webhook()
+    await bot.set_webhook(url=PUBLIC_URL + WEBHOOK_PATH)
+    logger.info("Webhook registered")
+
+@app.on_event("shutdown")
+async def close_bot_session():
+    if _polly_keepalive_task is not None:
+        _polly_keepalive_task.cancel()
+    await _polly_stack.aclose()
+    await bot.close_session()
+
+# Strong references to in-flight update tasks - asyncio only keeps weak ones,
+# so without this a task could be garbage-collected mid-processing and the
+# update silently dropped
+_update_tasks = set()
+
+def _log_update_result(task):
+    _update_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error processing update: {task.exception()}", exc_info=task.exception())
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    update = telebot.types.Update.de_json(await request.json())
+    # ACK Telegram immediately; process the update concurrently so slow
+    # Gemini/Polly calls for one user don't delay delivery for others
+    task = asyncio.create_task(bot.process_new_updates([update]))
+    _update_tasks.add(task)
+    task.add_done_callback(_log_update_result)
+    return {"ok": True}
 
 # Start the bot
 if __name__ == "__main__":
-    print("Bot is running...")
-    bot.infinity_polling()
+    logger.info("Bot is running...")
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8443)))